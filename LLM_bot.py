@@ -1,339 +1,891 @@
 from catanatron import Player
+from catanatron.game import TURNS_LIMIT
+from catanatron.models.enums import RESOURCES, ActionPrompt
 from catanatron_experimental.cli.cli_players import register_player
-from openai import OpenAI
-import json
+from catanatron_experimental.machine_learning.players.value import get_value_fn
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from collections import OrderedDict
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
+import logging
+import operator
+import openai
+import orjson
+import random
 import time
 import os
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+log = logging.getLogger(__name__)
 
-@register_player("GEMINI2_0")
-class Gemini2_0Player(Player):
-    def __init__(self, color, is_bot=True):
-        super().__init__(color, is_bot)
-        self.client = OpenAI(
+RESOURCE_KEYS = tuple(RESOURCES)  # WOOD, BRICK, SHEEP, WHEAT, ORE
+DEV_KEYS = ("KNIGHT", "VICTORY_POINT", "YEAR_OF_PLENTY", "MONOPOLY", "ROAD_BUILDING")
+# player_state fields (after the "P{i}_" prefix) shown in a player's block
+OTHER_BLOCK_FIELDS = ("VICTORY_POINTS",) + tuple(f"{r}_IN_HAND" for r in RESOURCE_KEYS)
+OWN_BLOCK_FIELDS = OTHER_BLOCK_FIELDS + tuple(f"{d}_IN_HAND" for d in DEV_KEYS)
+
+# Sections of the state string sent to the model (see get_state_string).
+# Outside of regular turns most of the state is noise, and every section left
+# out saves prompt tokens, i.e. cost and time to first token.
+FULL_SECTIONS = ("phase", "players", "buildings", "bank", "special", "actions")
+PHASE_SECTIONS = {
+    # Nobody has cards yet; only where things are built matters
+    "initial_build": ("phase", "identity", "buildings", "special", "actions"),
+    # Only our own hand matters for what to give up
+    "discarding": ("phase", "own_player", "special", "actions"),
+    # Where to put the robber and whom to steal from
+    "moving_robber": ("phase", "other_players", "buildings", "special", "actions"),
+}
+
+# Longer action lists (initial placements, late-game trades) are pruned to the
+# best ones by a one-ply value function before being listed in the prompt.
+MAX_PROMPT_ACTIONS = 20
+
+# Decisions already made for an identical (model, state, actions) prompt, so
+# repeated states (e.g. opening placements across games) skip the API call.
+# Kept in memory and persisted on disk, so later runs start warm.
+DECISION_CACHE_SIZE = 4096
+# Defaults to $CATANATRON_LLM_CACHE_DIR, else ~/.catanatron_llm_cache
+DISK_CACHE_DIR = None
+DISK_CACHE_SIZE_LIMIT = 500 * 1024 * 1024  # bytes
+DISK_CACHE_EXPIRE = 7 * 24 * 60 * 60  # seconds
+_decision_cache = OrderedDict()
+_disk_cache = None
+
+
+def _get_disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        _load_env()
+        directory = DISK_CACHE_DIR or os.getenv(
+            "CATANATRON_LLM_CACHE_DIR", os.path.expanduser("~/.catanatron_llm_cache")
+        )
+        _disk_cache = diskcache.Cache(directory, size_limit=DISK_CACHE_SIZE_LIMIT)
+    return _disk_cache
+
+
+def _decision_cache_key(model, state_output, num_actions):
+    digest = hashlib.blake2b(state_output.encode(), digest_size=16).hexdigest()
+    return f"{model}|{digest}|{num_actions}"
+
+
+def _cache_get(key):
+    action_idx = _decision_cache.get(key)
+    if action_idx is not None:
+        _decision_cache.move_to_end(key)
+        return action_idx
+
+    action_idx = _get_disk_cache().get(key)
+    if action_idx is not None:
+        _remember(key, action_idx)
+    return action_idx
+
+
+def _cache_put(key, action_idx):
+    _remember(key, action_idx)
+    _get_disk_cache().set(key, action_idx, expire=DISK_CACHE_EXPIRE)
+
+
+def _remember(key, action_idx):
+    _decision_cache[key] = action_idx
+    _decision_cache.move_to_end(key)
+    if len(_decision_cache) > DECISION_CACHE_SIZE:
+        _decision_cache.popitem(last=False)
+
+
+def _parse_completion(completion, num_actions):
+    """Returns the action index chosen in completion, or None if unusable."""
+    if not completion.choices or not completion.choices[0].message:
+        return None
+    return _extract_idx(completion.choices[0].message.content, num_actions)
+
+
+def _extract_idx(content, num_actions):
+    """Parses the {"selected_action": N} JSON we ask for (or a bare N) out of
+    a model response. Returns None if missing, malformed or out of range."""
+    if not content:
+        return None
+    try:
+        parsed = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        content = content.strip()
+        # Not isdigit(): it also accepts e.g. "²", which int() rejects
+        parsed = int(content) if content.isdecimal() else None
+    if isinstance(parsed, dict):
+        parsed = parsed.get("selected_action")
+    if type(parsed) is int and 0 <= parsed < num_actions:  # bools are not indices
+        return parsed
+    return None
+
+
+def _completion_body(request, stream):
+    """The request as JSON bytes, in a single orjson pass. Posting these
+    skips chat.completions.create's transform of its params, a typed walk
+    over the whole prompt and schema that costs ~0.5ms a call."""
+    body = dict(request, stream=stream)
+    body.update(body.pop("extra_body", None) or {})
+    return orjson.dumps(body)
+
+
+def _create_completion(client, body, stream=False):
+    """Same as client.chat.completions.create(stream=stream, **request), for
+    a body encoded by _completion_body."""
+    return client.post(
+        "/chat/completions",
+        body=body,
+        cast_to=ChatCompletion,
+        stream=stream,
+        stream_cls=openai.Stream[ChatCompletionChunk],
+    )
+
+
+async def _create_completion_async(client, body, stream=False):
+    """Async version of _create_completion."""
+    return await client.post(
+        "/chat/completions",
+        body=body,
+        cast_to=ChatCompletion,
+        stream=stream,
+        stream_cls=openai.AsyncStream[ChatCompletionChunk],
+    )
+
+
+async def _read_stream_async(stream, num_actions):
+    """Returns the action index in a streamed completion, or None if the
+    whole response has no valid index.
+
+    Over HTTP/2 (see _get_async_client) it hangs up as soon as the index
+    parses, which only resets that one stream and skips the tail of the
+    response. Over HTTP/1.1, closing a response before it is fully read also
+    closes its connection, so the tail is read (and ignored) instead.
+    """
+    hang_up = stream.response.http_version == "HTTP/2"
+    content, action_idx = "", None
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta and action_idx is None:
+                content += delta
+                if "}" in delta:
+                    action_idx = _extract_idx(content, num_actions)
+                    if action_idx is not None and hang_up:
+                        break
+    except (httpx.TransportError, openai.APIError) as e:
+        if action_idx is not None:
+            return action_idx  # the tail we were only draining broke off
+        raise _stream_read_error(e) from e
+    finally:
+        await stream.close()
+    if action_idx is None:
+        action_idx = _extract_idx(content, num_actions)  # e.g. a bare number
+    return action_idx
+
+
+def _stream_read_error(error):
+    """Errors reading a response stream (a dropped or stalled connection, or
+    an {"error": ...} event from the provider) are raised by the SDK as is,
+    unlike errors sending the request. Wrapped as an APIConnectionError, they
+    are retried the same way."""
+    if isinstance(error, openai.APIStatusError):
+        return error
+    return openai.APIConnectionError(
+        message=f"Reading the response stream failed: {error}", request=error.request
+    )
+
+
+# Errors worth retrying; anything else (auth, bad request, ...) is raised right away.
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.InternalServerError,
+)
+
+
+def _backoff_delay(error, attempt, base_delay, max_delay):
+    """Seconds to wait before retrying after a transient API error.
+
+    Honors the server's Retry-After header when present, otherwise backs off
+    exponentially. Rate limits get jitter so concurrent games don't re-collide.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return max(0.0, float(response.headers["retry-after"]))
+        except (KeyError, ValueError):
+            pass
+
+    delay = min(max_delay, base_delay * 2**attempt)
+    if isinstance(error, openai.RateLimitError):
+        delay += random.uniform(0, 0.25)
+    return delay
+
+
+def _log_failure(attempt, error, state_output, completion):
+    # Lazy %s formatting: the (large) state is only rendered if DEBUG is on
+    log.warning("Attempt %d failed with error: %s", attempt + 1, error)
+    log.debug("State that caused the error:\n%s", state_output)
+    if completion is not None:
+        log.debug("Model response:\n%s", completion)
+
+
+async def play_game_async(game, accumulators=[]):
+    """Like Game.play, but awaits decide_async on players that support it,
+    so many games can wait on the LLM API concurrently.
+
+    Returns:
+        Color: winning color or None if game exceeded TURNS_LIMIT
+    """
+    for accumulator in accumulators:
+        accumulator.before(game)
+    while game.winning_color() is None and game.state.num_turns < TURNS_LIMIT:
+        player = game.state.current_player()
+        actions = game.state.playable_actions
+        if hasattr(player, "decide_async"):
+            action = await player.decide_async(game, actions)
+        else:
+            action = player.decide(game, actions)
+        for accumulator in accumulators:
+            accumulator.step(game, action)
+        game.execute(action)
+    for accumulator in accumulators:
+        accumulator.after(game)
+    return game.winning_color()
+
+
+async def play_games_async(games, make_accumulators=None):
+    """Plays all games concurrently. Returns list of winning colors.
+
+    Accumulators keep the state of the game they are in on themselves (e.g.
+    StatisticsAccumulator's start time), so they can't be shared by games
+    that interleave. make_accumulators(game), if given, is called for each
+    game and must return new accumulator instances for it.
+    """
+    per_game = [make_accumulators(game) if make_accumulators else [] for game in games]
+    seen = set()
+    for accumulators in per_game:
+        for accumulator in accumulators:
+            if id(accumulator) in seen:
+                raise ValueError(f"{accumulator!r} is shared by concurrent games")
+            seen.add(id(accumulator))
+    return await asyncio.gather(
+        *[play_game_async(game, acc) for game, acc in zip(games, per_game)]
+    )
+
+
+def play_games(games, make_accumulators=None):
+    """Synchronous entry point for play_games_async."""
+
+    async def run():
+        try:
+            return await play_games_async(games, make_accumulators)
+        finally:
+            coordinators = {
+                player.coordinator
+                for game in games
+                for player in game.state.players
+                if getattr(player, "coordinator", None) is not None
+            }
+            for coordinator in coordinators:
+                await coordinator.close()
+            await _close_async_client()
+
+    return asyncio.run(run())
+
+
+@functools.lru_cache(maxsize=None)
+def _load_env():
+    """Loads environment variables from .env file, once and only when an LLM
+    player actually needs them (not when this module is merely imported)."""
+    load_dotenv()
+
+
+def _get_api_key():
+    _load_env()
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise RuntimeError(
+            "OPENROUTER_API_KEY is not set (in the environment or a .env file)"
+        )
+    return api_key
+
+
+# Sync client shared by every LLM player (clients are thread-safe), so all
+# bots in a process reuse one pool of kept-alive connections.
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = OpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=_get_api_key(),
+            max_retries=0,  # retries are handled (with backoff) in decide
+        )
+    return _client
+
+
+# Async client shared by every LLM player, so concurrent games multiplex
+# their requests over a few kept-alive HTTP/2 connections instead of each
+# paying TCP + TLS setup. A connection pool can't outlive the event loop that
+# opened its connections, so a new client is made for each loop.
+_async_client = None
+_async_client_loop = None
+
+
+def _get_async_client():
+    """Returns the shared AsyncOpenAI client for the running event loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncOpenAI(
             base_url="https://openrouter.ai/api/v1",
-            api_key=os.getenv("OPENROUTER_API_KEY"),
+            api_key=_get_api_key(),
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                timeout=30.0,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            ),
         )
-        self.max_retries = 2
-        self.retry_delay = 1  # seconds
+        _async_client_loop = loop
+    return _async_client
+
+
+async def _close_async_client():
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.close()
+    _async_client = None
+    _async_client_loop = None
+
+
+class BatchedLLMCoordinator:
+    """Packs decisions from concurrently running games into a single API call.
+
+    Players with a coordinator (see decide_async) submit their state here
+    instead of calling the API. Submissions are collected until max_batch of
+    them are waiting or max_wait seconds passed, then the model is asked to
+    pick an action for every state at once. This amortizes per-request
+    overhead and rate limits when evaluating many games in parallel
+    (e.g. with play_games). Use one coordinator per model.
+    """
+
+    PROMPT_HEADER = (
+        "You are an AI that plays Catan. Below are the states of several "
+        "independent games. For each game, analyze its state and choose the "
+        "best possible move from its list of playable actions. Return one "
+        "decision per game with the game_id and the selected action number (idx)."
+    )
+    RESPONSE_FORMAT = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "catan_moves",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "decisions": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "game_id": {"type": "integer"},
+                                "idx": {"type": "integer"},
+                            },
+                            "required": ["game_id", "idx"],
+                            "additionalProperties": False,
+                        },
+                    }
+                },
+                "required": ["decisions"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+    def __init__(self, model, max_batch=4, max_wait=0.05, client=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # seconds
+        self.client = client  # None uses the shared client, see _get_async_client
+        self.num_calls = 0
+        self._queue = None
+        self._loop = None
+        # The collector and in-flight batches. The event loop only keeps weak
+        # references to tasks, so without these they could be collected mid-run.
+        self._tasks = set()
+
+    async def submit(self, state_output, num_actions):
+        """Returns the action index chosen for state_output, or None if the
+        batched call failed or gave no valid answer for it."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:  # queues and tasks are bound to their loop
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._tasks = set()
+            self._spawn(self._collect_batches())
+
+        future = loop.create_future()
+        self._queue.put_nowait((state_output, num_actions, future))
+        return await future
+
+    async def _collect_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Don't hold up collecting the next batch on this one's round-trip
+            self._spawn(self._decide_batch(batch))
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Cancels the collector and any batch still waiting on the API.
+        Must be awaited on the loop the coordinator ran on (play_games does
+        this for its players' coordinators once every game is over)."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop = None
+        self._queue = None
+
+    async def _decide_batch(self, batch):
+        prompt = [self.PROMPT_HEADER]
+        for game_id, (state_output, num_actions, _) in enumerate(batch):
+            prompt.append(f"\n--- game_id: {game_id} ---\n{state_output}")
+
+        completion = None
+        try:
+            self.num_calls += 1
+            client = self.client or _get_async_client()
+            completion = await client.chat.completions.create(
+                extra_body={},
+                model=self.model,
+                messages=[{"role": "user", "content": "\n".join(prompt)}],
+                response_format=self.RESPONSE_FORMAT,
+            )
+            decisions = _extract_decisions(completion, batch)
+        except RETRYABLE_ERRORS as e:
+            _log_failure(0, e, f"<batch of {len(batch)} states>", completion)
+            decisions = {}
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for game_id, (_, _, future) in enumerate(batch):
+            if not future.done():  # i.e. the waiting decision was cancelled
+                future.set_result(decisions.get(game_id))
+
+
+def _extract_decisions(completion, batch):
+    """Maps game_id => valid action index from a BatchedLLMCoordinator response."""
+    if not completion.choices or not completion.choices[0].message:
+        return {}
+    try:
+        content = orjson.loads(completion.choices[0].message.content or "")
+        decisions = content["decisions"]
+    except (orjson.JSONDecodeError, TypeError, KeyError):
+        return {}
+
+    result = {}
+    for decision in decisions if isinstance(decisions, list) else []:
+        if not isinstance(decision, dict):
+            continue
+        game_id, idx = decision.get("game_id"), decision.get("idx")
+        if (
+            type(game_id) is int
+            and 0 <= game_id < len(batch)
+            and type(idx) is int
+            and 0 <= idx < batch[game_id][1]
+        ):
+            result[game_id] = idx
+    return result
+
+
+class _LLMPlayerBase(Player):
+    """Shared logic for players that pick actions by prompting an LLM
+    through OpenRouter. Subclasses set the model and prompts."""
+
+    MODEL = None
+    SYSTEM_PROMPT = None  # optional system message
+    # Formatted with state_output and max_action (index of last action)
+    USER_PROMPT_TEMPLATE = None
+    # Whether the response schema bounds selected_action to the valid range
+    BOUNDED_SCHEMA = False
+
+    def __init__(self, color, is_bot=True):
+        super().__init__(color, is_bot)
+        # Clients are only resolved on the first API call, see _call_llm
+        self.client = None  # None uses the shared client, see _get_client
+        self.aclient = None  # None uses the shared client, see _get_async_client
+        self.coordinator = None  # optional BatchedLLMCoordinator for decide_async
+        # Stream responses in decide_async, parsing the action as soon as it
+        # arrives (see _read_stream_async). Turned off if the provider only
+        # accepts the request without streaming. decide doesn't stream: the
+        # sync client speaks HTTP/1.1, where the whole response has to be
+        # read anyway, so streaming would only add SSE overhead.
+        self.stream = True
+        # Built once; only selected_action's maximum changes between calls
+        self._response_format = self._build_response_format()
+        self._selected_action_schema = self._response_format["json_schema"][
+            "schema"
+        ]["properties"]["selected_action"]
+        # Reused too; only the user message's content changes between calls
+        self._messages = [{"role": "user", "content": ""}]
+        if self.SYSTEM_PROMPT is not None:
+            self._messages.insert(0, {"role": "system", "content": self.SYSTEM_PROMPT})
+        self.max_retries = 5
+        self.base_delay = 0.5  # seconds
+        self.max_delay = 16  # seconds
+        self._skipped = 0  # decisions with a single playable action (no API call)
+        self.max_prompt_actions = MAX_PROMPT_ACTIONS  # None to list every action
+        # Rendered player blocks and the player_state values they were
+        # rendered from, by color. Most turns only change one player.
+        self._last_ps_snapshot = {}
+        self._last_blocks = {}
+        self._block_getters = {}  # (color, player key) => itemgetter of fields
+        # color => "P{i}" player_state prefix, for the game whose
+        # color_to_index it was built from (seats change between games)
+        self._key_cache = {}
+        self._key_cache_source = None
 
     def decide(self, game, playable_actions):
         """Uses LLM to choose best action using structured output.
-        
+
         Args:
             game (Game): complete game state. read-only.
             playable_actions (Iterable[Action]): options to choose from
         Return:
             action (Action): Chosen element of playable_actions
         """
+        if len(playable_actions) == 1:
+            self._skipped += 1
+            return playable_actions[0]
+
+        # Keyed on every playable action, so cache hits skip pruning too
         state_output = self.get_state_string(game, playable_actions)
-        
-        # Add debug prints
-        player_idx = game.state.color_to_index[self.color]
-        key = f"P{player_idx}"
-        #print(f"\nGemini 2.0 Turn {game.state.num_turns}")
-        #print(f"Current VP: {game.state.player_state[f'{key}_VICTORY_POINTS']}")
-        
-        for attempt in range(self.max_retries):
-            try:
-                completion = self.client.chat.completions.create(
-                    extra_body={},
-                    model="google/gemini-2.0-flash-001",
-                    messages=[{
-                        "role": "user",
-                        "content": f"""
-                        You are an AI that plays Catan. Given a game state, you should analyze it and choose the best possible move from the list of actions. Only return the action number.
-                        {state_output}
-                        Only return the action number
-                        """
-                    }],
-                    response_format={
-                        "type": "json_schema",
-                        "json_schema": {
-                            "name": "catan_move",
-                            "strict": True,
-                            "schema": {
-                                "type": "object",
-                                "properties": {
-                                    "selected_action": {
-                                        "type": "integer",
-                                        "description": "The number of the selected action from the available actions list",
-                                        "minimum": 0,
-                                        "maximum": len(playable_actions) - 1
-                                    }
-                                },
-                                "required": ["selected_action"],
-                                "additionalProperties": False
-                            }
-                        }
-                    }
-                )
-                
-                #print(f"LLM Output: {completion.choices[0].message.content}")  # Print LLM output
-                
-                if not completion.choices or not completion.choices[0].message or not completion.choices[0].message.content:
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay)
-                        continue
-                    return playable_actions[0]
-                
-                try:
-                    # Try parsing as JSON first
-                    content = json.loads(completion.choices[0].message.content)
-                    action_idx = content["selected_action"]
-                    
-                    # If we get here, we have a valid action_idx
-                    if 0 <= action_idx < len(playable_actions):
-                        return playable_actions[action_idx]  # Return immediately on success
-                    
-                except (json.JSONDecodeError, KeyError):
-                    # If JSON parsing fails, try parsing as plain integer
-                    try:
-                        action_idx = int(completion.choices[0].message.content.strip())
-                        if 0 <= action_idx < len(playable_actions):
-                            return playable_actions[action_idx]  # Return immediately on success
-                    except ValueError:
-                        pass  # Let it continue to next attempt
-                
-                # If we get here, the action was invalid
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                    continue
-                
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}")
-                print(f"State that caused the error:\n{state_output}")
-                if 'completion' in locals():
-                    print(f"Model response:\n{completion}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                    continue
-                
-            # If we get here, all attempts failed or were invalid
+        cache_key = _decision_cache_key(self.MODEL, state_output, len(playable_actions))
+        action_idx = _cache_get(cache_key)
+        if action_idx is None:
+            prompt, kept = self._prompt(game, playable_actions, state_output)
+            idx = self._call_llm(prompt, len(kept))
+            if idx is None:
+                return playable_actions[kept[0]]  # all attempts failed or were invalid
+            action_idx = kept[idx]
+            _cache_put(cache_key, action_idx)
+        return playable_actions[action_idx]
+
+    async def decide_async(self, game, playable_actions):
+        """Same as decide, but awaits the API call so other games can run meanwhile."""
+        if len(playable_actions) == 1:
+            self._skipped += 1
             return playable_actions[0]
 
-    def get_state_string(self, game, playable_actions):
-        """Returns the game state as a formatted string."""
-        output = []
-        output.append("=== DEBUG BOT STATE ===")
-        # Game Phase Information
-        output.append("Game Phase:")
-        output.append(f"  Current Prompt: {game.state.current_prompt}")
-        output.append(f"  Initial Build Phase: {game.state.is_initial_build_phase}")
-        output.append(f"  Turn Number: {game.state.num_turns}")
-        
-        # Player Information
-        output.append("\nPlayers:")
-        output.append(f"I am playing as: {self.color}")
-        for color in game.state.colors:
-            player_idx = game.state.color_to_index[color]
-            key = f"P{player_idx}"
-            output.append(f"\n{color}{'(ME)' if color == self.color else ''}:")
-            output.append(f"  Victory Points: {game.state.player_state[f'{key}_VICTORY_POINTS']}")
-            if color == self.color:  # Only show detailed resources for self
-                output.append(f"  Resources:")
-                output.append(f"    Wood: {game.state.player_state[f'{key}_WOOD_IN_HAND']}")
-                output.append(f"    Brick: {game.state.player_state[f'{key}_BRICK_IN_HAND']}")
-                output.append(f"    Sheep: {game.state.player_state[f'{key}_SHEEP_IN_HAND']}")
-                output.append(f"    Wheat: {game.state.player_state[f'{key}_WHEAT_IN_HAND']}")
-                output.append(f"    Ore: {game.state.player_state[f'{key}_ORE_IN_HAND']}")
-                output.append(f"  Development Cards:")
-                output.append(f"    Knights: {game.state.player_state[f'{key}_KNIGHT_IN_HAND']}")
-                output.append(f"    Victory Points: {game.state.player_state[f'{key}_VICTORY_POINT_IN_HAND']}")
-                output.append(f"    Year of Plenty: {game.state.player_state[f'{key}_YEAR_OF_PLENTY_IN_HAND']}")
-                output.append(f"    Monopoly: {game.state.player_state[f'{key}_MONOPOLY_IN_HAND']}")
-                output.append(f"    Road Building: {game.state.player_state[f'{key}_ROAD_BUILDING_IN_HAND']}")
-            else:  # Just show total cards for others
-                total_resources = (
-                    game.state.player_state[f'{key}_WOOD_IN_HAND'] +
-                    game.state.player_state[f'{key}_BRICK_IN_HAND'] +
-                    game.state.player_state[f'{key}_SHEEP_IN_HAND'] +
-                    game.state.player_state[f'{key}_WHEAT_IN_HAND'] +
-                    game.state.player_state[f'{key}_ORE_IN_HAND']
-                )
-                output.append(f"  Total Resource Cards: {total_resources}")
-        
-        # Board State
-        output.append("\nBoard State:")
-        output.append(f"  Buildings: {game.state.buildings_by_color}")
-        output.append(f"  Resource Bank: {game.state.resource_freqdeck}")
-        output.append(f"  Development Cards Left: {len(game.state.development_listdeck)}")
-        
-        # Special States
-        if game.state.is_discarding:
-            output.append("\nDiscard Phase Active")
-        if game.state.is_moving_knight:
-            output.append("\nKnight Movement Active")
-        if game.state.is_resolving_trade:
-            output.append(f"\nTrade Active: {game.state.current_trade}")
-        
-        output.append("\nPlayable Actions:")
-        for i, action in enumerate(playable_actions):
-            output.append(f"{i}: {action}")
-        output.append("=====================")
-        
-        return "\n".join(output) 
-    
-@register_player("OPENAI_GPT4O_MINI")
-class OpenAIGPT4OMiniPlayer(Player):
-    def __init__(self, color, is_bot=True):
-        super().__init__(color, is_bot)
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=os.getenv("OPENROUTER_API_KEY"),
+        state_output = self.get_state_string(game, playable_actions)
+        cache_key = _decision_cache_key(self.MODEL, state_output, len(playable_actions))
+        action_idx = _cache_get(cache_key)
+        if action_idx is None:
+            prompt, kept = self._prompt(game, playable_actions, state_output)
+            idx = None
+            if self.coordinator is not None:
+                idx = await self.coordinator.submit(prompt, len(kept))
+            if idx is None:  # no coordinator, or no valid batched answer
+                idx = await self._call_llm_async(prompt, len(kept))
+            if idx is None:
+                return playable_actions[kept[0]]
+            action_idx = kept[idx]
+            _cache_put(cache_key, action_idx)
+        return playable_actions[action_idx]
+
+    def _prompt(self, game, playable_actions, state_output):
+        """The state to prompt the model with, and the indices into
+        playable_actions of the actions it lists (see _prune_actions)."""
+        kept = self._prune_actions(game, playable_actions)
+        if kept is None:
+            return state_output, range(len(playable_actions))
+        candidates = [playable_actions[i] for i in kept]
+        return self.get_state_string(game, candidates), kept
+
+    def _prune_actions(self, game, playable_actions):
+        """Indices of the max_prompt_actions best actions, in their original
+        order, or None if there aren't more actions than that.
+
+        Actions are ranked like ValueFunctionPlayer does: by the base value
+        function of the game after executing each one on a copy.
+        """
+        k = self.max_prompt_actions
+        if k is None or len(playable_actions) <= k:
+            return None
+        value_fn = get_value_fn("base_fn", None)
+        scores = []
+        for action in playable_actions:
+            game_copy = game.copy()
+            game_copy.execute(action)
+            scores.append(value_fn(game_copy, self.color))
+        best = sorted(
+            range(len(playable_actions)), key=scores.__getitem__, reverse=True
         )
-        self.max_retries = 2
-        self.retry_delay = 1  # seconds
+        return sorted(best[:k])
 
-    def decide(self, game, playable_actions):
-        state_output = self.get_state_string(game, playable_actions)
-        
-        # Add debug prints
-        player_idx = game.state.color_to_index[self.color]
-        key = f"P{player_idx}"
-        #print(f"\nGPT4O Mini Turn {game.state.num_turns}")
-        #print(f"Current VP: {game.state.player_state[f'{key}_VICTORY_POINTS']}")
-        
+    def _call_llm(self, state_output, num_actions):
+        """Asks the model for an action index, retrying on transient failures.
+
+        Returns:
+            int | None: index into playable_actions, None if all attempts failed
+        """
+        body = _completion_body(
+            self._completion_request(state_output, num_actions), stream=False
+        )
+        client = self.client or _get_client()
         for attempt in range(self.max_retries):
+            completion = None
+            delay = self.base_delay
             try:
-                completion = self.client.chat.completions.create(
-                    extra_body={
-                    },
-                    model="openai/gpt-4o-mini",
-                    messages=[{
-                        "role": "system",
-                        "content": """You are a Catan-playing AI that returns moves in JSON format."""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""Analyze this game state and choose the best possible move from the list of actions.
-                        Only return a number between 0 and {len(playable_actions) - 1}.
-                        {state_output}"""
-                    }],
-                    response_format={
-                        "type": "json_schema",
-                        "json_schema": {
-                            "name": "catan_move",
-                            "strict": True,
-                            "schema": {
-                                "type": "object",
-                                "properties": {
-                                    "selected_action": {
-                                        "type": "integer",
-                                        "description": "The number of the selected action from the available actions list"
-                                    }
-                                },
-                                "required": ["selected_action"],
-                                "additionalProperties": False
-                            }
-                        }
-                    }
-                )
-                
-                #print(f"LLM Output: {completion.choices[0].message.content}")  # Print LLM output
-                
-                if not completion.choices or not completion.choices[0].message or not completion.choices[0].message.content:
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay)
-                        continue
-                    return playable_actions[0]
-                
-                try:
-                    # Try parsing as JSON first
-                    content = json.loads(completion.choices[0].message.content)
-                    action_idx = content["selected_action"]
-                    
-                    # If we get here, we have a valid action_idx
-                    if 0 <= action_idx < len(playable_actions):
-                        return playable_actions[action_idx]  # Return immediately on success
-                    
-                except (json.JSONDecodeError, KeyError):
-                    # If JSON parsing fails, try parsing as plain integer
-                    try:
-                        action_idx = int(completion.choices[0].message.content.strip())
-                        if 0 <= action_idx < len(playable_actions):
-                            return playable_actions[action_idx]  # Return immediately on success
-                    except ValueError:
-                        pass  # Let it continue to next attempt
-                
-                # If we get here, the action was invalid
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                    continue
-                
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}")
-                print(f"State that caused the error:\n{state_output}")
-                if 'completion' in locals():
-                    print(f"Model response:\n{completion}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                    continue
-                
-            # If we get here, all attempts failed or were invalid
-            return playable_actions[0]
+                completion = _create_completion(client, body)
+                action_idx = _parse_completion(completion, num_actions)
+                if action_idx is not None:
+                    return action_idx
+            except RETRYABLE_ERRORS as e:
+                _log_failure(attempt, e, state_output, completion)
+                delay = _backoff_delay(e, attempt, self.base_delay, self.max_delay)
+
+            # If we get here, the response was empty, invalid or failed
+            if attempt < self.max_retries - 1:
+                time.sleep(delay)
+        return None
+
+    async def _call_llm_async(self, state_output, num_actions):
+        """Async version of _call_llm."""
+        bodies = self._completion_bodies(state_output, num_actions)
+        aclient = self.aclient or _get_async_client()
+        streaming = self.stream
+        for attempt in range(self.max_retries):
+            completion = None
+            delay = self.base_delay
+            try:
+                if streaming:
+                    stream = await _create_completion_async(
+                        aclient, bodies[True], stream=True
+                    )
+                    action_idx = await _read_stream_async(stream, num_actions)
+                else:
+                    completion = await _create_completion_async(aclient, bodies[False])
+                    # Accepted without streaming, so if the 400 below was
+                    # about streaming, stop trying it for good
+                    self.stream = streaming
+                    action_idx = _parse_completion(completion, num_actions)
+                if action_idx is not None:
+                    return action_idx
+            except openai.BadRequestError:
+                if not streaming:
+                    raise
+                # Maybe the provider can't stream this; try without. Any other
+                # 400 (context length, unknown model, ...) fails again, above.
+                streaming = False
+                continue
+            except RETRYABLE_ERRORS as e:
+                _log_failure(attempt, e, state_output, completion)
+                delay = _backoff_delay(e, attempt, self.base_delay, self.max_delay)
+
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(delay)
+        return None
+
+    def _build_response_format(self):
+        selected_action = {
+            "type": "integer",
+            "description": "The number of the selected action from the available actions list",
+        }
+        if self.BOUNDED_SCHEMA:
+            selected_action["minimum"] = 0
+            selected_action["maximum"] = 0  # set per call in _completion_request
+
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "catan_move",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {"selected_action": selected_action},
+                    "required": ["selected_action"],
+                    "additionalProperties": False
+                }
+            }
+        }
+
+    def _completion_request(self, state_output, num_actions):
+        """Keyword arguments for chat.completions.create."""
+        self._messages[-1]["content"] = self.USER_PROMPT_TEMPLATE.format(
+            state_output=state_output, max_action=num_actions - 1
+        )
+
+        if self.BOUNDED_SCHEMA:
+            self._selected_action_schema["maximum"] = num_actions - 1
+
+        return dict(
+            extra_body={},
+            model=self.MODEL,
+            messages=self._messages,
+            response_format=self._response_format,
+        )
+
+    def _completion_bodies(self, state_output, num_actions):
+        """Encoded request bodies for one decision, streaming (True) or not.
+
+        The messages and schema in the request are shared by every decision
+        this player makes, and a player can be deciding in several concurrent
+        games. Encoding them right away, before anything is awaited, keeps a
+        retry from sending whatever prompt another game wrote there since.
+        """
+        request = self._completion_request(state_output, num_actions)
+        return {stream: _completion_body(request, stream) for stream in (True, False)}
 
     def get_state_string(self, game, playable_actions):
-        """Returns the game state as a formatted string."""
-        output = []
-        output.append("=== DEBUG BOT STATE ===")
-        # Game Phase Information
-        output.append("Game Phase:")
-        output.append(f"  Current Prompt: {game.state.current_prompt}")
-        output.append(f"  Initial Build Phase: {game.state.is_initial_build_phase}")
-        output.append(f"  Turn Number: {game.state.num_turns}")
-        
-        # Player Information
-        output.append("\nPlayers:")
-        output.append(f"I am playing as: {self.color}")
-        for color in game.state.colors:
-            player_idx = game.state.color_to_index[color]
-            key = f"P{player_idx}"
-            output.append(f"\n{color}{'(ME)' if color == self.color else ''}:")
-            output.append(f"  Victory Points: {game.state.player_state[f'{key}_VICTORY_POINTS']}")
-            if color == self.color:  # Only show detailed resources for self
-                output.append(f"  Resources:")
-                output.append(f"    Wood: {game.state.player_state[f'{key}_WOOD_IN_HAND']}")
-                output.append(f"    Brick: {game.state.player_state[f'{key}_BRICK_IN_HAND']}")
-                output.append(f"    Sheep: {game.state.player_state[f'{key}_SHEEP_IN_HAND']}")
-                output.append(f"    Wheat: {game.state.player_state[f'{key}_WHEAT_IN_HAND']}")
-                output.append(f"    Ore: {game.state.player_state[f'{key}_ORE_IN_HAND']}")
-                output.append(f"  Development Cards:")
-                output.append(f"    Knights: {game.state.player_state[f'{key}_KNIGHT_IN_HAND']}")
-                output.append(f"    Victory Points: {game.state.player_state[f'{key}_VICTORY_POINT_IN_HAND']}")
-                output.append(f"    Year of Plenty: {game.state.player_state[f'{key}_YEAR_OF_PLENTY_IN_HAND']}")
-                output.append(f"    Monopoly: {game.state.player_state[f'{key}_MONOPOLY_IN_HAND']}")
-                output.append(f"    Road Building: {game.state.player_state[f'{key}_ROAD_BUILDING_IN_HAND']}")
-            else:  # Just show total cards for others
-                total_resources = (
-                    game.state.player_state[f'{key}_WOOD_IN_HAND'] +
-                    game.state.player_state[f'{key}_BRICK_IN_HAND'] +
-                    game.state.player_state[f'{key}_SHEEP_IN_HAND'] +
-                    game.state.player_state[f'{key}_WHEAT_IN_HAND'] +
-                    game.state.player_state[f'{key}_ORE_IN_HAND']
-                )
-                output.append(f"  Total Resource Cards: {total_resources}")
-        
-        # Board State
-        output.append("\nBoard State:")
-        output.append(f"  Buildings: {game.state.buildings_by_color}")
-        output.append(f"  Resource Bank: {game.state.resource_freqdeck}")
-        output.append(f"  Development Cards Left: {len(game.state.development_listdeck)}")
-        
-        # Special States
-        if game.state.is_discarding:
-            output.append("\nDiscard Phase Active")
-        if game.state.is_moving_knight:
-            output.append("\nKnight Movement Active")
-        if game.state.is_resolving_trade:
-            output.append(f"\nTrade Active: {game.state.current_trade}")
-        
-        output.append("\nPlayable Actions:")
-        for i, action in enumerate(playable_actions):
-            output.append(f"{i}: {action}")
-        output.append("=====================")
-        
-        return "\n".join(output) 
\ No newline at end of file
+        """Returns the game state as a formatted string. Sections that don't
+        matter in the current phase are left out (see PHASE_SECTIONS)."""
+        state = game.state
+        if state.is_initial_build_phase:
+            names = PHASE_SECTIONS["initial_build"]
+        elif state.is_discarding:
+            names = PHASE_SECTIONS["discarding"]
+        # .is_moving_knight is never reset by the engine, so use the prompt
+        elif state.current_prompt == ActionPrompt.MOVE_ROBBER:
+            names = PHASE_SECTIONS["moving_robber"]
+        else:
+            names = FULL_SECTIONS
+
+        sections = self._render_sections(game, playable_actions)
+        blocks = ["=== DEBUG BOT STATE ==="]
+        blocks.extend(sections[name] for name in names if sections[name])
+        blocks.append("=====================")
+        return "\n".join(blocks)
+
+    def _render_sections(self, game, playable_actions):
+        """Renders every section get_state_string may include, by name."""
+        state = game.state
+        ps = state.player_state
+        players_header = f"\nPlayers:\nI am playing as: {self.color}"
+        player_blocks, other_blocks = [players_header], [players_header]
+        if self._key_cache_source is not state.color_to_index:
+            self._key_cache = {c: f"P{i}" for c, i in state.color_to_index.items()}
+            self._key_cache_source = state.color_to_index
+        for color in state.colors:
+            snapshot = self._block_getter(color, self._key_cache[color])(ps)
+            if self._last_ps_snapshot.get(color) != snapshot:
+                self._last_ps_snapshot[color] = snapshot
+                self._last_blocks[color] = self._player_block(color, snapshot)
+            player_blocks.append(self._last_blocks[color])
+            if color != self.color:
+                other_blocks.append(self._last_blocks[color])
+
+        special = []
+        if state.is_discarding:
+            special.append("\nDiscard Phase Active")
+        if state.is_moving_knight:
+            special.append("\nKnight Movement Active")
+        if state.is_resolving_trade:
+            special.append(f"\nTrade Active: {state.current_trade}")
+
+        return {
+            "phase": (
+                "Game Phase:\n"
+                f"  Current Prompt: {state.current_prompt}\n"
+                f"  Initial Build Phase: {state.is_initial_build_phase}\n"
+                f"  Turn Number: {state.num_turns}"
+            ),
+            "identity": f"\nI am playing as: {self.color}",
+            "players": "\n".join(player_blocks),
+            "own_player": f"{players_header}\n{self._last_blocks[self.color]}",
+            "other_players": "\n".join(other_blocks),
+            "buildings": f"\nBoard State:\n  Buildings: {state.buildings_by_color}",
+            "bank": (
+                f"  Resource Bank: {state.resource_freqdeck}\n"
+                f"  Development Cards Left: {len(state.development_listdeck)}"
+            ),
+            "special": "\n".join(special),
+            "actions": "\nPlayable Actions:\n"
+            + "\n".join(f"{i}: {a}" for i, a in enumerate(playable_actions)),
+        }
+
+    def _block_getter(self, color, key):
+        """Fetches all of a player's block fields from player_state in one
+        C-level call, instead of building and hashing each key per turn."""
+        getter = self._block_getters.get((color, key))
+        if getter is None:
+            fields = OWN_BLOCK_FIELDS if color == self.color else OTHER_BLOCK_FIELDS
+            getter = operator.itemgetter(*[f"{key}_{field}" for field in fields])
+            self._block_getters[(color, key)] = getter
+        return getter
+
+    def _player_block(self, color, values):
+        """Section of get_state_string describing one player, from the values
+        of OWN_BLOCK_FIELDS (for us) or OTHER_BLOCK_FIELDS (for others). Only
+        our own hand is shown in detail; for others just the total card count."""
+        if color != self.color:
+            return (
+                f"\n{color}:\n"
+                f"  Victory Points: {values[0]}\n"
+                f"  Total Resource Cards: {sum(values[1:])}"
+            )
+
+        vps, wood, brick, sheep, wheat, ore, knight, vp, yop, monopoly, road = values
+        return (
+            f"\n{color}(ME):\n"
+            f"  Victory Points: {vps}\n"
+            "  Resources:\n"
+            f"    Wood: {wood}\n"
+            f"    Brick: {brick}\n"
+            f"    Sheep: {sheep}\n"
+            f"    Wheat: {wheat}\n"
+            f"    Ore: {ore}\n"
+            "  Development Cards:\n"
+            f"    Knights: {knight}\n"
+            f"    Victory Points: {vp}\n"
+            f"    Year of Plenty: {yop}\n"
+            f"    Monopoly: {monopoly}\n"
+            f"    Road Building: {road}"
+        )
+
+
+@register_player("GEMINI2_0")
+class Gemini2_0Player(_LLMPlayerBase):
+    """Asks Gemini 2.0 Flash (through OpenRouter) to choose among playable actions."""
+
+    MODEL = "google/gemini-2.0-flash-001"
+    USER_PROMPT_TEMPLATE = """
+You are an AI that plays Catan. Given a game state, you should analyze it and choose the best possible move from the list of actions. Only return the action number.
+{state_output}
+Only return the action number
+"""
+    BOUNDED_SCHEMA = True
+
+
+@register_player("OPENAI_GPT4O_MINI")
+class OpenAIGPT4OMiniPlayer(_LLMPlayerBase):
+    """Asks GPT-4o mini (through OpenRouter) to choose among playable actions."""
+
+    MODEL = "openai/gpt-4o-mini"
+    SYSTEM_PROMPT = "You are a Catan-playing AI that returns moves in JSON format."
+    USER_PROMPT_TEMPLATE = """Analyze this game state and choose the best possible move from the list of actions.
+Only return a number between 0 and {max_action}.
+{state_output}"""
@@ -108,6 +108,7 @@ def register_player(code):
                 player_class,
             ),
         )
+        return player_class
 
     return decorator
 
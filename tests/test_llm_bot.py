@@ -0,0 +1,686 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import orjson
+import pytest
+
+from catanatron import Game, RandomPlayer, Color
+from catanatron.models.enums import Action, ActionType
+from catanatron_experimental.cli.accumulators import StatisticsAccumulator
+
+import LLM_bot
+from tests.utils import build_initial_placements
+from LLM_bot import Gemini2_0Player, OpenAIGPT4OMiniPlayer
+
+
+class FakeStream:
+    """Streams content a few characters per chunk."""
+
+    def __init__(self, content):
+        self.pieces = [content[i : i + 4] for i in range(0, len(content), 4)]
+        self.chunks_read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.chunks_read += 1
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncStream(FakeStream):
+    response = SimpleNamespace(http_version="HTTP/2")
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+    async def close(self):
+        super().close()
+
+
+class FakeCompletions:
+    stream_class = FakeStream
+
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+        self.streams = []
+        self.requests = []
+
+    def create(self, stream=False, **kwargs):
+        self.calls += 1
+        self.requests.append(kwargs)
+        if stream:
+            self.streams.append(self.stream_class(self.content))
+            return self.streams[-1]
+        message = SimpleNamespace(content=self.content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FlakyCompletions(FakeCompletions):
+    """Raises the given errors first, then answers with content."""
+
+    def __init__(self, content, errors):
+        super().__init__(content)
+        self.errors = list(errors)
+
+    def create(self, **kwargs):
+        if self.errors:
+            self.calls += 1
+            raise self.errors.pop(0)
+        return super().create(**kwargs)
+
+
+def api_error(error_class, status_code, headers={}):
+    request = httpx.Request("POST", "https://openrouter.ai/api/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return error_class("error", response=response, body=None)
+
+
+class FakeAsyncCompletions(FakeCompletions):
+    stream_class = FakeAsyncStream
+
+    async def create(self, **kwargs):
+        return super().create(**kwargs)
+
+
+class FlakyAsyncCompletions(FlakyCompletions):
+    stream_class = FakeAsyncStream
+
+    async def create(self, **kwargs):
+        return super().create(**kwargs)
+
+
+class FakeClient:
+    """Stands in for (Async)OpenAI; completions are posted as raw JSON."""
+
+    def __init__(self, completions):
+        self.chat = SimpleNamespace(completions=completions)
+
+    def post(self, path, *, body, cast_to, stream=False, stream_cls=None):
+        assert path == "/chat/completions"
+        return self.chat.completions.create(**orjson.loads(body))
+
+
+def completion_json(content):
+    message = {"role": "assistant", "content": content}
+    return {
+        "id": "gen-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "test",
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+    }
+
+
+def chunk_json(content):
+    delta = {"role": "assistant", "content": content}
+    return {
+        "id": "gen-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "test",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+    }
+
+
+def fake_client(content, completions_class=FakeCompletions):
+    return FakeClient(completions_class(content))
+
+
+def set_hand(game, color, **resources):
+    key = f"P{game.state.color_to_index[color]}"
+    for resource in LLM_bot.RESOURCE_KEYS:
+        game.state.player_state[f"{key}_{resource}_IN_HAND"] = resources.get(
+            resource, 0
+        )
+
+
+@pytest.fixture(autouse=True)
+def clean_llm_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    monkeypatch.setattr(LLM_bot, "DISK_CACHE_DIR", str(tmp_path / "llm_cache"))
+    monkeypatch.setattr(LLM_bot, "_disk_cache", None)
+    LLM_bot._decision_cache.clear()
+    yield
+    if LLM_bot._disk_cache is not None:
+        LLM_bot._disk_cache.close()
+
+
+@pytest.mark.parametrize("player_class", [Gemini2_0Player, OpenAIGPT4OMiniPlayer])
+def test_llm_player_skips_api_on_single_action(player_class):
+    player = player_class(Color.RED)
+    player.client = fake_client('{"selected_action": 0}')
+    game = Game([player, RandomPlayer(Color.BLUE)])
+
+    actions = [Action(Color.RED, ActionType.ROLL, None)]
+    assert player.decide(game, actions) == actions[0]
+    assert player.client.chat.completions.calls == 0
+    assert player._skipped == 1
+
+
+@pytest.mark.parametrize("player_class", [Gemini2_0Player, OpenAIGPT4OMiniPlayer])
+def test_llm_player_caches_repeated_states(player_class):
+    player = player_class(Color.RED)
+    player.client = fake_client('{"selected_action": 3}')
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    first = player.decide(game, actions)
+    assert first == actions[3]
+    assert player.decide(game, actions) == first
+    assert player.client.chat.completions.calls == 1
+
+
+def test_llm_player_prunes_long_action_lists(monkeypatch):
+    player = Gemini2_0Player(Color.RED)
+    player.client = fake_client('{"selected_action": 19}')
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions
+    assert len(actions) > LLM_bot.MAX_PROMPT_ACTIONS
+
+    kept = player._prune_actions(game, actions)
+    assert len(kept) == LLM_bot.MAX_PROMPT_ACTIONS
+    assert kept == sorted(kept)  # original order kept
+    assert player.decide(game, actions) == actions[kept[19]]
+    (request,) = player.client.chat.completions.requests
+    prompt = request["messages"][-1]["content"]
+    assert "19: " in prompt and "20: " not in prompt
+
+    # Cached on the full action list, so a repeat doesn't prune again
+    monkeypatch.setattr(player, "_prune_actions", pytest.fail)
+    assert player.decide(game, actions) == actions[kept[19]]
+    assert player.client.chat.completions.calls == 1
+
+    player.max_prompt_actions = None
+    assert Gemini2_0Player._prune_actions(player, game, actions) is None
+
+
+def test_llm_player_uses_client_assigned_after_first_call():
+    player = Gemini2_0Player(Color.RED)
+    player.client = fake_client('{"selected_action": 3}')
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    assert player.decide(game, game.state.playable_actions[:5]) is not None
+
+    player.client = fake_client('{"selected_action": 1}')
+    actions = game.state.playable_actions[5:10]
+    assert player.decide(game, actions) == actions[1]
+    assert player.client.chat.completions.calls == 1
+
+
+def test_decision_cache_persists_to_disk():
+    player = Gemini2_0Player(Color.RED)
+    player.client = fake_client('{"selected_action": 3}')
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+    assert player.decide(game, actions) == actions[3]
+
+    LLM_bot._decision_cache.clear()  # as if in a new process
+    player.client = fake_client('{"selected_action": 1}')
+    assert player.decide(game, actions) == actions[3]
+    assert player.client.chat.completions.calls == 0
+
+
+@pytest.mark.parametrize("player_class", [Gemini2_0Player, OpenAIGPT4OMiniPlayer])
+def test_llm_players_play_concurrent_games(player_class):
+    games = []
+    for _ in range(3):
+        player = player_class(Color.RED)
+        player.client = fake_client("not used")
+        player.aclient = fake_client('{"selected_action": 0}', FakeAsyncCompletions)
+        games.append(Game([player, RandomPlayer(Color.BLUE)]))
+
+    winners = LLM_bot.play_games(games)
+
+    assert len(winners) == 3
+    for game in games:
+        llm_player = next(p for p in game.state.players if p.color == Color.RED)
+        assert game.state.num_turns > 0
+        assert llm_player.client.chat.completions.calls == 0
+        assert llm_player.aclient.chat.completions.calls > 0
+
+
+class AsyncRandomPlayer(RandomPlayer):
+    async def decide_async(self, game, playable_actions):
+        await asyncio.sleep(0)  # let the other games run
+        return self.decide(game, playable_actions)
+
+
+def test_play_games_gives_each_game_its_own_accumulators():
+    games = [
+        Game(
+            [AsyncRandomPlayer(Color.RED), AsyncRandomPlayer(Color.BLUE)], vps_to_win=3
+        )
+        for _ in range(3)
+    ]
+    stats = {}
+
+    def make_accumulators(game):
+        stats[game.id] = StatisticsAccumulator()
+        return [stats[game.id]]
+
+    winners = LLM_bot.play_games(games, make_accumulators)
+
+    for game, winner in zip(games, winners):
+        assert winner is not None
+        assert stats[game.id].games == [game]
+        assert stats[game.id].wins == {winner: 1}
+        assert len(stats[game.id].durations) == 1
+
+
+def test_play_games_rejects_shared_accumulators():
+    shared = StatisticsAccumulator()
+    games = [
+        Game([RandomPlayer(Color.RED), RandomPlayer(Color.BLUE)]) for _ in range(2)
+    ]
+
+    with pytest.raises(ValueError, match="shared by concurrent games"):
+        LLM_bot.play_games(games, lambda game: [shared])
+    assert all(game.state.num_turns == 0 for game in games)
+
+
+def test_llm_player_backs_off_on_rate_limits(monkeypatch, caplog):
+    caplog.set_level("WARNING", logger="LLM_bot")
+    sleeps = []
+    monkeypatch.setattr(LLM_bot.time, "sleep", sleeps.append)
+    player = Gemini2_0Player(Color.RED)
+    errors = [
+        api_error(openai.RateLimitError, 429, {"retry-after": "7"}),
+        api_error(openai.RateLimitError, 429),
+        api_error(openai.InternalServerError, 500),
+    ]
+    player.client = FakeClient(FlakyCompletions('{"selected_action": 2}', errors))
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    assert player.decide(game, actions) == actions[2]
+    assert player.client.chat.completions.calls == 4
+    assert sleeps[0] == 7
+    assert 1 <= sleeps[1] <= 1.25
+    assert sleeps[2] == 2
+    assert len(caplog.records) == 3
+    assert "DEBUG BOT STATE" not in caplog.text  # state is only logged on DEBUG
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected", [("7", 7), ("0", 0), ("-3", 0), ("soon", 0.5)]
+)
+def test_backoff_delay_honors_retry_after(retry_after, expected):
+    error = api_error(openai.InternalServerError, 503, {"retry-after": retry_after})
+    assert LLM_bot._backoff_delay(error, 0, 0.5, 16) == expected
+
+
+def test_llm_player_retries_with_its_own_prompt_across_games():
+    player = Gemini2_0Player(Color.RED)
+    errors = [api_error(openai.RateLimitError, 429, {"retry-after": "0"})]
+    player.aclient = FakeClient(FlakyAsyncCompletions('{"selected_action": 1}', errors))
+    games = [Game([player, RandomPlayer(Color.BLUE)]) for _ in range(2)]
+    action_lists = [games[0].state.playable_actions[:3]]
+    action_lists.append(games[1].state.playable_actions[5:10])
+
+    async def decide_both():  # the first decision backs off while the second runs
+        return await asyncio.gather(
+            *[player.decide_async(g, a) for g, a in zip(games, action_lists)]
+        )
+
+    first, second = asyncio.run(decide_both())
+
+    assert first == action_lists[0][1]
+    assert second == action_lists[1][1]
+    completions = player.aclient.chat.completions
+    assert completions.calls == 3
+    second_request, retry = completions.requests
+    retry_schema = retry["response_format"]["json_schema"]["schema"]
+    assert retry_schema["properties"]["selected_action"]["maximum"] == 2
+    assert str(action_lists[0][2]) in retry["messages"][-1]["content"]
+    assert str(action_lists[1][0]) not in retry["messages"][-1]["content"]
+    assert str(action_lists[1][0]) in second_request["messages"][-1]["content"]
+
+
+@pytest.mark.parametrize("answered", [False, True])
+@pytest.mark.parametrize("failure", ["timeout", "error_event"])
+def test_llm_player_retries_streams_that_fail_midway(caplog, failure, answered):
+    caplog.set_level("WARNING", logger="LLM_bot")
+    events = [chunk_json('{"selected_'), chunk_json('action": 1}')]
+    sent = []
+
+    def sse(event):
+        return f"data: {orjson.dumps(event).decode()}\n\n".encode()
+
+    async def failing_events():
+        for event in events if answered else events[:1]:
+            yield sse(event)
+        if failure == "timeout":
+            raise httpx.ReadTimeout("timed out")
+        yield sse({"error": {"message": "provider overloaded", "code": 502}})
+
+    def handler(request):
+        sent.append(request)
+        if len(sent) == 1:
+            content = failing_events()
+        else:
+            content = b"".join(map(sse, events)) + b"data: [DONE]\n\n"
+        headers = {"content-type": "text/event-stream"}
+        return httpx.Response(200, headers=headers, content=content)
+
+    player = Gemini2_0Player(Color.RED)
+    player.base_delay = 0
+    player.aclient = openai.AsyncOpenAI(
+        api_key="test",
+        base_url="https://openrouter.test/api/v1",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    assert asyncio.run(player.decide_async(game, actions)) == actions[1]
+    # An answer that parsed before the (drained) tail broke off is kept
+    assert len(sent) == (1 if answered else 2)
+    assert len(caplog.records) == (0 if answered else 1)
+
+
+def test_llm_player_raises_non_retryable_errors(monkeypatch):
+    monkeypatch.setattr(LLM_bot.time, "sleep", lambda _: None)
+    player = OpenAIGPT4OMiniPlayer(Color.RED)
+    errors = [api_error(openai.AuthenticationError, 401)]
+    player.client = FakeClient(FlakyCompletions("0", errors))
+    game = Game([player, RandomPlayer(Color.BLUE)])
+
+    with pytest.raises(openai.AuthenticationError):
+        player.decide(game, game.state.playable_actions)
+
+
+@pytest.mark.parametrize(
+    "use_async, stream", [(False, False), (True, False), (True, True)]
+)
+def test_completions_are_posted_as_prebuilt_json(use_async, stream):
+    sent = []
+
+    def handler(request):
+        sent.append(orjson.loads(request.content))
+        if not stream:
+            return httpx.Response(200, json=completion_json('{"selected_action": 2}'))
+        chunks = [chunk_json(piece) for piece in ('{"selected_', 'action": 2}')]
+        events = "".join(f"data: {orjson.dumps(c).decode()}\n\n" for c in chunks)
+        return httpx.Response(
+            200,
+            content=events + "data: [DONE]\n\n",
+            headers={"content-type": "text/event-stream"},
+        )
+
+    player = OpenAIGPT4OMiniPlayer(Color.RED)
+    transport = httpx.MockTransport(handler)
+    client_options = dict(api_key="test", base_url="https://openrouter.test/api/v1")
+    if use_async:
+        player.stream = stream
+        player.aclient = openai.AsyncOpenAI(
+            **client_options, http_client=httpx.AsyncClient(transport=transport)
+        )
+        assert asyncio.run(player._call_llm_async("STATE", 5)) == 2
+    else:  # decide never streams, whatever player.stream says
+        player.client = openai.OpenAI(
+            **client_options, http_client=httpx.Client(transport=transport)
+        )
+        assert player._call_llm("STATE", 5) == 2
+
+    (body,) = sent
+    assert body["model"] == "openai/gpt-4o-mini"
+    assert body["stream"] is stream
+    assert "extra_body" not in body
+    assert "STATE" in body["messages"][-1]["content"]
+
+
+def test_llm_players_completion_requests():
+    gemini = Gemini2_0Player(Color.RED)
+    gemini_request = gemini._completion_request("OLD STATE", 3)
+    gemini_request = gemini._completion_request("STATE", 5)
+    gpt_request = OpenAIGPT4OMiniPlayer(Color.RED)._completion_request("STATE", 5)
+
+    gemini_schema = gemini_request["response_format"]["json_schema"]["schema"]
+    assert gemini_request["model"] == "google/gemini-2.0-flash-001"
+    assert [m["role"] for m in gemini_request["messages"]] == ["user"]
+    assert "STATE" in gemini_request["messages"][0]["content"]
+    assert "OLD STATE" not in gemini_request["messages"][0]["content"]
+    assert gemini_request["messages"] is gemini._messages  # reused across calls
+    assert gemini_schema["properties"]["selected_action"]["maximum"] == 4
+
+    gpt_schema = gpt_request["response_format"]["json_schema"]["schema"]
+    assert gpt_request["model"] == "openai/gpt-4o-mini"
+    assert [m["role"] for m in gpt_request["messages"]] == ["system", "user"]
+    assert "between 0 and 4" in gpt_request["messages"][1]["content"]
+    assert "maximum" not in gpt_schema["properties"]["selected_action"]
+
+
+def test_get_state_string_hides_other_players_hands():
+    player = Gemini2_0Player(Color.RED)
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    build_initial_placements(game)
+    set_hand(game, Color.RED, WOOD=2)
+    set_hand(game, Color.BLUE, WOOD=2, ORE=1)
+
+    state_output = player.get_state_string(game, game.state.playable_actions)
+
+    assert "I am playing as: Color.RED" in state_output
+    assert state_output.count("  Resources:") == 1
+    assert "    Wood: 2" in state_output
+    assert "  Total Resource Cards: 3" in state_output
+    assert state_output.endswith("=====================")
+
+
+def test_async_client_is_shared_per_event_loop():
+    async def get_clients():
+        return LLM_bot._get_async_client(), LLM_bot._get_async_client()
+
+    first, second = asyncio.run(get_clients())
+    assert first is second
+    third, _ = asyncio.run(get_clients())
+    assert third is not first
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [
+        ('{"selected_action": 2}', 2),
+        ('{"selected_action": 5}', None),  # out of range
+        ('{"selected_action": true}', None),
+        ('{"selected_action": "1"}', None),
+        ('{"other": 1}', None),
+        (" 3\n", 3),
+        ("03", 3),
+        ("-1", None),
+        ("action 1", None),
+        ("²", None),
+        ("1²", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_extract_idx(content, expected):
+    assert LLM_bot._extract_idx(content, 5) == expected
+
+
+def test_get_state_string_omits_sections_irrelevant_to_phase():
+    player = Gemini2_0Player(Color.RED)
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    initial_output = player.get_state_string(game, game.state.playable_actions)
+    build_initial_placements(game)
+    full_output = player.get_state_string(game, game.state.playable_actions)
+    game.state.is_discarding = True
+    discard_output = player.get_state_string(game, game.state.playable_actions)
+
+    assert "Resource Bank" in full_output
+    assert "Total Resource Cards" in full_output
+    assert "I am playing as: Color.RED" in initial_output
+    assert "Buildings" in initial_output
+    assert "Resource Bank" not in initial_output
+    assert "Victory Points" not in initial_output
+    assert "(ME)" in discard_output
+    assert "Total Resource Cards" not in discard_output
+    assert "Buildings" not in discard_output
+    assert len(discard_output) < len(full_output)
+
+
+def test_get_state_string_rerenders_only_changed_players():
+    player = Gemini2_0Player(Color.RED)
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    build_initial_placements(game)
+    set_hand(game, Color.BLUE)
+
+    player.get_state_string(game, game.state.playable_actions)
+    blocks = dict(player._last_blocks)
+    set_hand(game, Color.BLUE, SHEEP=4)
+    state_output = player.get_state_string(game, game.state.playable_actions)
+
+    assert player._last_blocks[Color.RED] is blocks[Color.RED]
+    assert player._last_blocks[Color.BLUE] is not blocks[Color.BLUE]
+    assert "  Total Resource Cards: 4" in state_output
+
+
+def test_batched_coordinator_packs_concurrent_decisions():
+    content = '{"decisions": [{"game_id": 0, "idx": 1}, {"game_id": 1, "idx": 9}]}'
+    client = fake_client(content, FakeAsyncCompletions)
+    coordinator = LLM_bot.BatchedLLMCoordinator(
+        "google/gemini-2.0-flash-001", client=client
+    )
+
+    async def submit_all():
+        results = await asyncio.gather(
+            coordinator.submit("STATE 0", 3),
+            coordinator.submit("STATE 1", 3),  # idx 9 is out of range
+            coordinator.submit("STATE 2", 3),  # missing from the response
+        )
+        (collector,) = coordinator._tasks  # the finished batch was dropped
+        await coordinator.close()
+        return results, collector
+
+    results, collector = asyncio.run(submit_all())
+    assert results == [1, None, None]
+    assert client.chat.completions.calls == 1
+    assert collector.cancelled()
+    assert not coordinator._tasks
+
+
+def test_play_games_closes_coordinators():
+    player = Gemini2_0Player(Color.RED)
+    player.aclient = fake_client('{"selected_action": 0}', FakeAsyncCompletions)
+    player.coordinator = LLM_bot.BatchedLLMCoordinator(
+        player.MODEL, client=fake_client('{"decisions": []}', FakeAsyncCompletions)
+    )
+
+    LLM_bot.play_games([Game([player, RandomPlayer(Color.BLUE)])])
+
+    assert player.coordinator.num_calls > 0
+    assert player.coordinator._loop is None  # closed, not left to asyncio.run
+    assert not player.coordinator._tasks
+
+
+def test_llm_player_falls_back_when_batch_has_no_answer():
+    player = Gemini2_0Player(Color.RED)
+    player.aclient = fake_client('{"selected_action": 2}', FakeAsyncCompletions)
+    player.coordinator = LLM_bot.BatchedLLMCoordinator(
+        player.MODEL, client=fake_client('{"decisions": []}', FakeAsyncCompletions)
+    )
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    assert asyncio.run(player.decide_async(game, actions)) == actions[2]
+    assert player.coordinator.num_calls == 1
+    assert player.aclient.chat.completions.calls == 1
+
+
+def test_get_state_string_follows_seating_across_games():
+    player = Gemini2_0Player(Color.RED)
+    for _ in range(5):  # seating is shuffled for every game
+        game = Game([player, RandomPlayer(Color.BLUE)])
+        build_initial_placements(game)
+        set_hand(game, Color.RED, ORE=3)
+        set_hand(game, Color.BLUE, WOOD=1)
+
+        state_output = player.get_state_string(game, game.state.playable_actions)
+
+        assert "    Ore: 3" in state_output
+        assert "  Total Resource Cards: 1" in state_output
+
+
+def test_llm_players_share_one_client(monkeypatch):
+    monkeypatch.setattr(LLM_bot, "_client", None)
+    gemini = Gemini2_0Player(Color.RED)
+    gpt = OpenAIGPT4OMiniPlayer(Color.BLUE)
+    assert gemini.client is None and gpt.client is None  # resolved lazily
+    assert LLM_bot._get_client() is LLM_bot._get_client()
+
+
+def test_missing_api_key_fails_on_first_api_call(monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY")
+    monkeypatch.setattr(LLM_bot, "_client", None)
+    player = Gemini2_0Player(Color.RED)  # no error until the API is needed
+    game = Game([player, RandomPlayer(Color.BLUE)])
+
+    with pytest.raises(RuntimeError, match="OPENROUTER_API_KEY"):
+        player.decide(game, game.state.playable_actions)
+
+
+@pytest.mark.parametrize(
+    "http_version, hangs_up", [("HTTP/2", True), ("HTTP/1.1", False)]
+)
+def test_llm_player_hangs_up_streams_early_only_on_http2(
+    monkeypatch, http_version, hangs_up
+):
+    monkeypatch.setattr(
+        FakeAsyncStream, "response", SimpleNamespace(http_version=http_version)
+    )
+    player = Gemini2_0Player(Color.RED)
+    completions = FakeAsyncCompletions('{"selected_action": 1}' + " " * 40)
+    player.aclient = FakeClient(completions)
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    assert asyncio.run(player.decide_async(game, actions)) == actions[1]
+    (stream,) = completions.streams
+    assert stream.closed
+    # Otherwise the tail is read, so HTTP/1.1 keeps the connection alive
+    assert (stream.chunks_read < len(stream.pieces)) == hangs_up
+
+
+class NoStreamCompletions(FakeAsyncCompletions):
+    """Rejects streamed requests, like a provider that can't stream them."""
+
+    async def create(self, stream=False, **kwargs):
+        if stream:
+            self.calls += 1
+            raise api_error(openai.BadRequestError, 400)
+        return await super().create(**kwargs)
+
+
+def test_llm_player_falls_back_to_non_streaming():
+    player = OpenAIGPT4OMiniPlayer(Color.RED)
+    completions = NoStreamCompletions('{"selected_action": 2}')
+    player.aclient = FakeClient(completions)
+    game = Game([player, RandomPlayer(Color.BLUE)])
+    actions = game.state.playable_actions[:5]
+
+    assert asyncio.run(player.decide_async(game, actions)) == actions[2]
+    assert not player.stream
+    assert completions.calls == 2
+
+
+def test_llm_player_keeps_streaming_after_unrelated_bad_requests():
+    class BadRequestCompletions(FakeAsyncCompletions):
+        async def create(self, **kwargs):
+            self.calls += 1
+            raise api_error(openai.BadRequestError, 400)  # e.g. context length
+
+    player = OpenAIGPT4OMiniPlayer(Color.RED)
+    player.aclient = FakeClient(BadRequestCompletions("not used"))
+    game = Game([player, RandomPlayer(Color.BLUE)])
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(player.decide_async(game, game.state.playable_actions[:5]))
+    assert player.aclient.chat.completions.calls == 2  # streaming, then without
+    assert player.stream